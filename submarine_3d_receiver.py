@@ -5,6 +5,10 @@ Receives raw depth data via UDP and displays 3D point cloud
 """
 
 import socket
+import ctypes
+import errno
+import os
+import select
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
@@ -13,6 +17,138 @@ from matplotlib.animation import FuncAnimation
 import threading
 import sys
 
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    # Fall back to the NumPy point cloud path
+    HAVE_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+try:
+    from vispy import app as vispy_app, scene
+    HAVE_VISPY = True
+except ImportError:
+    # Fall back to the matplotlib viewer
+    HAVE_VISPY = False
+
+# Requested kernel receive buffer size (bytes)
+RECV_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Depths at or below this (millimeters) are treated as invalid
+MIN_DEPTH_MM = 100
+
+# Depth range (meters) mapped onto the jet colormap
+COLOR_RANGE = 5.0
+
+# Consumed bytes allowed at the front of the reassembly buffer before compacting
+COMPACT_THRESHOLD = 1 << 20
+
+# Raw depth packets: 12-byte header + [width(4)][height(4)][byte_offset(4)]
+RAW_HEADER_SIZE = 24
+
+# Largest UDP datagram and number of datagrams drained per recvmmsg(2) call
+MAX_DATAGRAM = 65536
+RECV_BATCH = 32
+
+class IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(IOVec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+try:
+    if not sys.platform.startswith('linux'):
+        raise OSError("recvmmsg is Linux only")
+    _recvmmsg = ctypes.CDLL(None, use_errno=True).recvmmsg
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint,
+                          ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+    HAVE_RECVMMSG = True
+except (OSError, AttributeError):
+    # Fall back to one recv_into per datagram
+    HAVE_RECVMMSG = False
+
+class RecvMMsg:
+    """Drain queued datagrams into preallocated buffers with one recvmmsg(2) call"""
+
+    def __init__(self, sock, buffers):
+        self.fd = sock.fileno()
+        count = len(buffers)
+
+        self._chunks = [(ctypes.c_char * len(b)).from_buffer(b) for b in buffers]
+        self._iovecs = (IOVec * count)()
+        self._msgs = (MMsgHdr * count)()
+
+        for i, chunk in enumerate(self._chunks):
+            self._iovecs[i].iov_base = ctypes.addressof(chunk)
+            self._iovecs[i].iov_len = len(chunk)
+            self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            self._msgs[i].msg_hdr.msg_iovlen = 1
+
+    def drain(self):
+        """Receive whatever is queued without blocking; returns datagram sizes"""
+        count = _recvmmsg(self.fd, self._msgs, len(self._msgs), socket.MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise OSError(err, os.strerror(err))
+        return [self._msgs[i].msg_len for i in range(count)]
+
+@njit(parallel=True, fastmath=True, cache=True)
+def unproject_depth(depth, out, step, inv_fx, inv_fy, cx, cy, min_depth_mm):
+    """Unproject every step-th pixel of a uint16 depth image (mm) into out.
+
+    Only points deeper than min_depth_mm are written, packed at the front of
+    out in row-major order. Returns the number of points written.
+    """
+    rows = (depth.shape[0] + step - 1) // step
+    cols = (depth.shape[1] + step - 1) // step
+
+    # Pass 1: count valid points per row so rows can be written in parallel
+    offsets = np.zeros(rows + 1, np.int64)
+    for r in prange(rows):
+        count = 0
+        for c in range(cols):
+            if depth[r * step, c * step] > min_depth_mm:
+                count += 1
+        offsets[r + 1] = count
+    for r in range(rows):
+        offsets[r + 1] += offsets[r]
+
+    # Pass 2: write X, Y, Z (Y flipped for visualization)
+    for r in prange(rows):
+        k = offsets[r]
+        v = r * step
+        for c in range(cols):
+            u = c * step
+            d = depth[v, u]
+            # Same integer test as pass 1 so each row writes exactly its count
+            if d > min_depth_mm:
+                z = np.float32(d) * np.float32(0.001)
+                out[k, 0] = (u - cx) * z * inv_fx
+                out[k, 1] = -(v - cy) * z * inv_fy
+                out[k, 2] = z
+                k += 1
+
+    return offsets[rows]
+
+
 class DepthReceiver3D:
     def __init__(self, port=5000):
         self.port = port
@@ -20,13 +156,49 @@ class DepthReceiver3D:
         self.depth_frame = None
         self.frame_lock = threading.Lock()
 
+        # Reassembly buffer; consumed bytes are skipped via `_head` and only
+        # compacted occasionally instead of re-slicing on every frame
+        self._buffer = bytearray()
+        self._head = 0
+
+        # Raw depth frame being assembled from chunk packets (frame_type=4)
+        self._raw_frame = None
+        self._raw_id = None
+        self._raw_bytes = 0
+
+        # Point cloud output buffer for the JIT path (allocated on first frame)
+        self._xyz_buf = None
+
+        # 256-entry uint8 RGBA jet lookup table for coloring points by depth
+        self._lut = (plt.cm.jet(np.linspace(0, 1, 256)) * 255).astype(np.uint8)
+
+        # Cached deprojection grids for the NumPy path
+        self._grid_shape = None
+        self._uu = None
+        self._vv = None
+
+        # Contiguous (N, 3) vertex buffer uploaded to the GPU by the VisPy viewer
+        self._gpu_buf = None
+
         # Create UDP socket
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind(('0.0.0.0', port))
         self.sock.settimeout(1.0)
 
+        # Enlarge kernel receive buffer so bursts of depth datagrams are not
+        # dropped while the decode thread is busy. Linux clamps this to
+        # net.core.rmem_max; raise it on the receiver if needed:
+        #   sudo sysctl -w net.core.rmem_max=12582912
+        #   sudo sysctl -w net.core.netdev_max_backlog=5000
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+        rcvbuf = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
         print(f"=== 3D Depth Receiver ===")
         print(f"Listening on port: {port}")
+        print(f"Receive buffer: {rcvbuf // 1024} KB")
+        print(f"Point cloud JIT: {'ENABLED' if HAVE_NUMBA else 'DISABLED (numba not installed)'}")
+        print(f"GPU viewer: {'ENABLED' if HAVE_VISPY else 'DISABLED (vispy not installed)'}")
+        print(f"Batched receive: {'ENABLED (recvmmsg)' if HAVE_RECVMMSG else 'DISABLED'}")
         print("Waiting for raw depth data...")
 
         # Start receiver thread
@@ -35,31 +207,27 @@ class DepthReceiver3D:
 
     def receive_loop(self):
         """Receive raw depth frames from UDP"""
-        buffer = b''
+        # Datagrams are received straight into preallocated packet buffers
+        count = RECV_BATCH if HAVE_RECVMMSG else 1
+        packets = [bytearray(MAX_DATAGRAM) for _ in range(count)]
+        views = [memoryview(p) for p in packets]
+
+        batch = RecvMMsg(self.sock, packets) if HAVE_RECVMMSG else None
 
         while self.running:
             try:
-                data, _ = self.sock.recvfrom(65536)
-
-                if len(data) >= 12:
-                    frame_id = int.from_bytes(data[0:4], 'little')
-                    frame_type = int.from_bytes(data[4:8], 'little')
-                    data_size = int.from_bytes(data[8:12], 'little')
-
-                    # Only process raw depth (frame_type=3)
-                    if frame_type == 3 and len(data) > 12:
-                        buffer += data[12:]
-
-                        if len(buffer) >= data_size:
-                            png_data = buffer[:data_size]
-                            buffer = buffer[data_size:]
-
-                            # Decode PNG
-                            depth_img = cv2.imdecode(np.frombuffer(png_data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
-
-                            if depth_img is not None:
-                                with self.frame_lock:
-                                    self.depth_frame = depth_img
+                if batch is not None:
+                    # Wait until something is queued (timing out so shutdown
+                    # is noticed), then take the whole burst in one recvmmsg
+                    readable, _, _ = select.select([self.sock], [], [], 1.0)
+                    if not readable:
+                        continue
+
+                    for i, size in enumerate(batch.drain()):
+                        self.handle_datagram(views[i], size)
+                else:
+                    n = self.sock.recv_into(packets[0])
+                    self.handle_datagram(views[0], n)
 
             except socket.timeout:
                 continue
@@ -68,6 +236,91 @@ class DepthReceiver3D:
                     print(f"Receive error: {e}")
                 break
 
+    def handle_datagram(self, view, n):
+        """Append one datagram to the reassembly buffer and decode complete frames"""
+        if n < 12:
+            return
+
+        frame_id = int.from_bytes(view[0:4], 'little')
+        frame_type = int.from_bytes(view[4:8], 'little')
+        data_size = int.from_bytes(view[8:12], 'little')
+
+        # Raw depth as uncompressed 16-bit chunks (frame_type=4)
+        if frame_type == 4:
+            self.handle_depth_chunk(view, n, frame_id, data_size)
+            return
+
+        # Raw depth as PNG (frame_type=3)
+        if frame_type != 3 or n <= 12:
+            return
+
+        buffer = self._buffer
+        buffer += view[12:n]
+
+        if len(buffer) - self._head >= data_size:
+            depth_img = self.decode_depth(buffer, self._head, data_size)
+            self._head += data_size
+
+            if self._head == len(buffer):
+                buffer.clear()
+                self._head = 0
+            elif self._head > COMPACT_THRESHOLD:
+                del buffer[:self._head]
+                self._head = 0
+
+            if depth_img is not None:
+                with self.frame_lock:
+                    self.depth_frame = depth_img
+
+    def handle_depth_chunk(self, view, n, frame_id, data_size):
+        """Copy one packet of raw uint16 depth into the frame being assembled"""
+        if n < RAW_HEADER_SIZE + data_size:
+            return
+
+        width = int.from_bytes(view[12:16], 'little')
+        height = int.from_bytes(view[16:20], 'little')
+        byte_offset = int.from_bytes(view[20:24], 'little')
+
+        frame_bytes = width * height * 2
+        if frame_bytes == 0 or byte_offset % 2 or data_size % 2 or \
+                byte_offset + data_size > frame_bytes:
+            return
+
+        # A new frame id means the previous frame will get no more chunks
+        if frame_id != self._raw_id:
+            self.publish_depth_frame()
+            self._raw_id = frame_id
+
+        if self._raw_frame is None or self._raw_frame.shape != (height, width):
+            self._raw_frame = np.zeros((height, width), np.uint16)
+            self._raw_bytes = 0
+
+        chunk = np.frombuffer(view, dtype=np.uint16, count=data_size // 2,
+                              offset=RAW_HEADER_SIZE)
+        start = byte_offset // 2
+        self._raw_frame.reshape(-1)[start:start + chunk.size] = chunk
+        self._raw_bytes += data_size
+
+        if self._raw_bytes >= frame_bytes:
+            self.publish_depth_frame()
+
+    def publish_depth_frame(self):
+        """Hand the assembled raw depth frame to the viewer"""
+        if not self._raw_bytes:
+            return
+
+        with self.frame_lock:
+            self.depth_frame = self._raw_frame
+
+        # Keep the previous pixels so packets lost in the next frame fall back to them
+        self._raw_frame = self._raw_frame.copy()
+        self._raw_bytes = 0
+
+    def decode_depth(self, buffer, offset, size):
+        """Decode a PNG depth image stored in buffer[offset:offset + size]"""
+        png_data = np.frombuffer(buffer, dtype=np.uint8, count=size, offset=offset)
+        return cv2.imdecode(png_data, cv2.IMREAD_UNCHANGED)
+
     def create_point_cloud(self, depth_img):
         """Create 3D point cloud from depth image"""
         # Downsample for performance
@@ -76,36 +329,105 @@ class DepthReceiver3D:
         # Get depth values
         h, w = depth_img.shape
 
-        # Create coordinate grid
-        x = np.arange(0, w, step)
-        y = np.arange(0, h, step)
-        xx, yy = np.meshgrid(x, y)
-
-        # Get depth values (in mm, convert to meters)
-        depth = depth_img[::step, ::step].astype(np.float32) / 1000.0
-
         # Camera intrinsics (approximate for Orbbec Astra)
         fx = fy = 525.0  # focal length
         cx = w / 2.0     # principal point x
         cy = h / 2.0     # principal point y
 
-        # Convert to 3D
-        valid = depth > 0.1  # Only include valid depths
+        if HAVE_NUMBA:
+            n_max = ((h + step - 1) // step) * ((w + step - 1) // step)
+            if self._xyz_buf is None or self._xyz_buf.shape[0] != n_max:
+                self._xyz_buf = np.empty((n_max, 3), np.float32)
+
+            n = unproject_depth(depth_img, self._xyz_buf, step,
+                                1.0 / fx, 1.0 / fy, cx, cy, MIN_DEPTH_MM)
+            xyz = self._xyz_buf[:n]
+
+            return xyz[:, 0], xyz[:, 1], xyz[:, 2], self.depth_colors(xyz[:, 2])
 
-        X = np.zeros_like(depth)
-        Y = np.zeros_like(depth)
-        Z = depth
+        # Normalized deprojection grids only depend on the image size, so
+        # they are built once and reused for every frame
+        if self._grid_shape != (h, w):
+            x = np.arange(0, w, step, dtype=np.float32)
+            y = np.arange(0, h, step, dtype=np.float32)
+            xx, yy = np.meshgrid(x, y)
+            self._uu = (xx - cx) / fx
+            self._vv = -(yy - cy) / fy  # Flip Y for visualization
+            self._grid_shape = (h, w)
 
-        X[valid] = (xx[valid] - cx) * Z[valid] / fx
-        Y[valid] = -(yy[valid] - cy) * Z[valid] / fy  # Flip Y for visualization
+        # Get depth values (in mm, convert to meters)
+        depth_mm = depth_img[::step, ::step]
+        depth = depth_mm.astype(np.float32) * 0.001
+
+        # Convert to 3D, applying the validity mask once
+        valid = depth_mm > MIN_DEPTH_MM  # Only include valid depths
 
-        # Color by depth
-        colors = plt.cm.jet(depth / 5.0)  # Normalize to 5m range
+        Z = depth[valid]
+        X = self._uu[valid] * Z
+        Y = self._vv[valid] * Z
 
-        return X[valid], Y[valid], Z[valid], colors[valid]
+        return X, Y, Z, self.depth_colors(Z)
+
+    def depth_colors(self, Z):
+        """Color points by depth (uint8 RGBA) via the jet lookup table"""
+        idx = np.clip(Z * (255.0 / COLOR_RANGE), 0, 255).astype(np.uint8)
+        return self._lut[idx]
 
     def run(self):
         """Main visualization loop"""
+        if HAVE_VISPY:
+            self.run_vispy()
+        else:
+            self.run_matplotlib()
+
+        self.running = False
+        self.sock.close()
+        print("\n3D Receiver closed")
+
+    def run_vispy(self):
+        """GPU point cloud viewer (VisPy)"""
+        canvas = scene.SceneCanvas(title='3D Point Cloud - Submarine Vision',
+                                   size=(1200, 800), keys='interactive', show=True)
+        view = canvas.central_widget.add_view()
+        view.camera = scene.TurntableCamera(elevation=-30, azimuth=0, distance=8,
+                                            center=(0, 0, 2.5))
+
+        scene.visuals.XYZAxis(parent=view.scene)
+        markers = scene.visuals.Markers(parent=view.scene)
+
+        print("\n3D Viewer active. Close window to exit.")
+
+        def update(event):
+            with self.frame_lock:
+                if self.depth_frame is not None:
+                    depth_img = self.depth_frame.copy()
+                else:
+                    return
+
+            try:
+                X, Y, Z, colors = self.create_point_cloud(depth_img)
+
+                # Pack points into one contiguous float32 buffer for upload
+                n = len(Z)
+                if self._gpu_buf is None or self._gpu_buf.shape[0] < n:
+                    self._gpu_buf = np.empty((n, 3), np.float32)
+                pos = self._gpu_buf[:n]
+                pos[:, 0] = X
+                pos[:, 1] = Y
+                pos[:, 2] = Z
+
+                markers.set_data(pos, face_color=colors * np.float32(1.0 / 255.0),
+                                 edge_width=0, size=2)
+
+            except Exception as e:
+                pass
+
+        timer = vispy_app.Timer(interval=0.1, connect=update, start=True)
+        vispy_app.run()
+        timer.stop()
+
+    def run_matplotlib(self):
+        """CPU point cloud viewer (matplotlib)"""
         fig = plt.figure(figsize=(12, 8))
         ax = fig.add_subplot(111, projection='3d')
 
@@ -118,52 +440,48 @@ class DepthReceiver3D:
         # Set initial view
         ax.view_init(elev=-30, azim=-90)
 
-        # Scatter plot placeholder
-        scatter = None
+        # Set consistent axis limits
+        ax.set_xlim(-3, 3)
+        ax.set_ylim(-3, 3)
+        ax.set_zlim(0, 5)
+
+        # Persistent scatter, updated in place every frame
+        scatter = ax.scatter([], [], [], s=1, alpha=0.6, depthshade=False)
 
         print("\n3D Viewer active. Close window to exit.")
 
         def update(frame):
-            nonlocal scatter
-
             with self.frame_lock:
                 if self.depth_frame is not None:
                     depth_img = self.depth_frame.copy()
                 else:
-                    return
+                    return scatter,
 
             try:
                 X, Y, Z, colors = self.create_point_cloud(depth_img)
 
-                # Remove old scatter
-                if scatter is not None:
-                    scatter.remove()
+                # Strided downsample to ~2000 points for rendering
+                stride = max(1, len(X) // 2000)
+                scatter._offsets3d = (X[::stride], Y[::stride], Z[::stride])
+                scatter.set_facecolor(colors[::stride] / 255.0)
 
-                # Create new scatter (downsample more for rendering)
-                idx = np.random.choice(len(X), min(2000, len(X)), replace=False)
-                scatter = ax.scatter(X[idx], Y[idx], Z[idx],
-                                   c=colors[idx], s=1, alpha=0.6)
-
-                # Set consistent axis limits
-                ax.set_xlim(-3, 3)
-                ax.set_ylim(-3, 3)
-                ax.set_zlim(0, 5)
+                # Blitting only calls draw_artist, which does not project 3D
+                # points; project here so the new points (and point count)
+                # reach the screen and the color order matches them
+                scatter.do_3d_projection()
 
             except Exception as e:
                 pass
 
             return scatter,
 
-        # Create animation
-        anim = FuncAnimation(fig, update, interval=100, cache_frame_data=False)
+        # Create animation (only the scatter is redrawn over a cached background)
+        anim = FuncAnimation(fig, update, interval=100, blit=True,
+                             cache_frame_data=False)
 
         plt.tight_layout()
         plt.show()
 
-        self.running = False
-        self.sock.close()
-        print("\n3D Receiver closed")
-
 def main():
     if len(sys.argv) < 2:
         print("Usage: submarine_3d_receiver.py <port>")
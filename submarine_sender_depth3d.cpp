@@ -13,6 +13,12 @@
 #include <cmath>
 #include <iostream>
 #include <cstring>
+#include <algorithm>
+#include <string>
+
+// Max raw depth payload per datagram; even, and with the 24-byte header plus
+// UDP/IP headers it fits a standard 1500-byte MTU
+const int MAX_RAW_PAYLOAD = 1400;
 
 // 2D Mapper
 class Map2D {
@@ -175,29 +181,63 @@ public:
         sendto(sockfd, packet.data(), packet.size(), 0,
                (const struct sockaddr*)&servaddr, sizeof(servaddr));
     }
+
+    void sendDepthRaw(const cv::Mat& depth, int frame_id, int frame_type) {
+        if (depth.empty() || depth.type() != CV_16UC1 || !depth.isContinuous()) return;
+
+        const int frame_bytes = depth.rows * depth.cols * 2;
+        std::vector<char> packet(24 + MAX_RAW_PAYLOAD);
+
+        // Split the image into chunks addressed by byte offset, so no datagram
+        // exceeds MAX_RAW_PAYLOAD regardless of the row width
+        for (int offset = 0; offset < frame_bytes; offset += MAX_RAW_PAYLOAD) {
+            int data_size = std::min(MAX_RAW_PAYLOAD, frame_bytes - offset);
+
+            // Create header: [frame_id(4)][frame_type(4)][data_size(4)]
+            //                [width(4)][height(4)][byte_offset(4)]
+            *(int*)&packet[0] = frame_id;
+            *(int*)&packet[4] = frame_type;
+            *(int*)&packet[8] = data_size;
+            *(int*)&packet[12] = depth.cols;
+            *(int*)&packet[16] = depth.rows;
+            *(int*)&packet[20] = offset;
+
+            // Copy raw 16-bit depth
+            memcpy(&packet[24], depth.data + offset, data_size);
+
+            // Send packet
+            sendto(sockfd, packet.data(), 24 + data_size, 0,
+                   (const struct sockaddr*)&servaddr, sizeof(servaddr));
+        }
+    }
 };
 
 // Frame type definitions
 enum FrameType {
     FRAME_DEPTH_VIS = 1,    // Depth visualization (colored)
     FRAME_2D_MAP = 2,       // 2D top-down map
-    FRAME_3D_DEPTH = 3      // Raw depth for 3D point cloud
+    FRAME_3D_DEPTH = 3,     // Raw depth for 3D point cloud (PNG)
+    FRAME_3D_DEPTH_RAW = 4  // Raw depth for 3D point cloud (uint16 chunks)
 };
 
 int main(int argc, char **argv) try {
     if (argc < 3) {
-        std::cout << "Usage: " << argv[0] << " <receiver_ip> <port>" << std::endl;
+        std::cout << "Usage: " << argv[0] << " <receiver_ip> <port> [png|raw]" << std::endl;
         std::cout << "Sends: Depth + 2D Map + 3D Point Cloud Data" << std::endl;
+        std::cout << "  png: 3D depth as PNG (default)" << std::endl;
+        std::cout << "  raw: 3D depth as uncompressed 16-bit data (LAN, no decode cost)" << std::endl;
         return 1;
     }
 
     std::string receiver_ip = argv[1];
     int port = std::atoi(argv[2]);
+    bool raw_depth = (argc > 3 && std::string(argv[3]) == "raw");
 
     std::cout << "=== Submarine Depth+3D Sender ===" << std::endl;
     std::cout << "Receiver IP: " << receiver_ip << std::endl;
     std::cout << "Port: " << port << std::endl;
     std::cout << "Streams: Depth Vis + 2D Map + 3D Data" << std::endl;
+    std::cout << "3D depth encoding: " << (raw_depth ? "raw" : "png") << std::endl;
 
     // Initialize UDP sender
     UDPSender sender(receiver_ip, port);
@@ -265,12 +305,18 @@ int main(int argc, char **argv) try {
                             sender.sendFrame(mapMat, frame_id, FRAME_2D_MAP);
                         }
 
-                        // 3. Send raw depth for 3D (PNG compressed to preserve 16-bit)
-                        std::vector<uchar> pngBuffer;
-                        std::vector<int> params = {cv::IMWRITE_PNG_COMPRESSION, 3};
-                        cv::imencode(".png", depthMat, pngBuffer, params);
-                        if (!pngBuffer.empty()) {
-                            sender.sendRawData(pngBuffer, frame_id, FRAME_3D_DEPTH);
+                        // 3. Send raw depth for 3D
+                        if (raw_depth) {
+                            // Uncompressed 16-bit depth, no encode/decode cost
+                            sender.sendDepthRaw(depthMat, frame_id, FRAME_3D_DEPTH_RAW);
+                        } else {
+                            // PNG compressed to preserve 16-bit
+                            std::vector<uchar> pngBuffer;
+                            std::vector<int> params = {cv::IMWRITE_PNG_COMPRESSION, 3};
+                            cv::imencode(".png", depthMat, pngBuffer, params);
+                            if (!pngBuffer.empty()) {
+                                sender.sendRawData(pngBuffer, frame_id, FRAME_3D_DEPTH);
+                            }
                         }
 
                         frame_id++;
@@ -4,22 +4,57 @@ Submarine Vision Web Server
 Receives video from Pi, runs ML detection, serves to web browser
 """
 
+import collections
 import cv2
+import os
 import socket
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, Response, render_template_string
 import numpy as np
 
+try:
+    # libjpeg-turbo (SIMD) encoder, much faster than cv2.imencode
+    from turbojpeg import TurboJPEG
+    jpeg_encoder = TurboJPEG()
+except Exception:
+    jpeg_encoder = None
+
+try:
+    # Greenlet-per-client WSGI server for MJPEG viewers
+    import gevent
+    from gevent.pywsgi import WSGIServer
+except ImportError:
+    gevent = None
+
 app = Flask(__name__)
 
 # Global variables
 latest_frame = None
+latest_frame_seq = 0
 frame_lock = threading.Lock()
 detection_enabled = True
 detected_objects_list = []
 object_count = 0
 
+# Requested kernel receive buffer size for the Pi connection (bytes)
+RECV_BUFFER_SIZE = 8 * 1024 * 1024
+
+# JPEG decode workers for incoming frames; the receiver blocks once this many
+# decodes are in flight
+DECODE_WORKERS = 2
+decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+
+# MJPEG stream encoding: single-pass baseline JPEG, frames taller than
+# MAX_STREAM_HEIGHT are downscaled to STREAM_HEIGHT before encoding
+JPEG_QUALITY = 75
+JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY,
+               cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+               cv2.IMWRITE_JPEG_PROGRESSIVE, 0]
+MAX_STREAM_HEIGHT = 720
+STREAM_HEIGHT = 540
+
 # HTML Template
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -269,17 +304,52 @@ HTML_TEMPLATE = """
 </html>
 """
 
+def recv_exact(sock, buf):
+    """Fill buf from sock, returns False if the connection closed first"""
+    view = memoryview(buf)
+    received = 0
+    while received < len(buf):
+        n = sock.recv_into(view[received:])
+        if not n:
+            return False
+        received += n
+    return True
+
+def decode_frame(frame_data, seq):
+    """Decode a JPEG frame and publish it unless a newer frame already was"""
+    global latest_frame, latest_frame_seq
+
+    frame_array = np.frombuffer(frame_data, dtype=np.uint8)
+    frame = cv2.imdecode(frame_array, cv2.IMREAD_COLOR)
+
+    if frame is not None:
+        with frame_lock:
+            if seq > latest_frame_seq:
+                latest_frame = frame
+                latest_frame_seq = seq
+
 def receive_frames():
     """Background thread: Receive frames from Pi"""
-    global latest_frame
-
     server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_sock.bind(('0.0.0.0', 5001))
+
+    # Set before listen() so accepted sockets inherit it and the TCP window
+    # scale negotiated at the handshake can use it. On Linux this disables
+    # receive autotuning and is clamped to 2 * net.core.rmem_max, so raise
+    # the limit on this machine first or the window ends up smaller:
+    #   sudo sysctl -w net.core.rmem_max=12582912
+    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+    rcvbuf = server_sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
     server_sock.listen(1)
 
+    print(f"[INFO] Receive buffer: {rcvbuf // 1024} KB")
     print("[INFO] Waiting for Pi on port 5001...")
 
+    size_data = bytearray(4)
+    seq = 0
+    pending = collections.deque()
+
     while True:
         try:
             client_sock, addr = server_sock.accept()
@@ -287,43 +357,70 @@ def receive_frames():
 
             while True:
                 # Receive frame size
-                size_data = client_sock.recv(4)
-                if not size_data or len(size_data) < 4:
+                if not recv_exact(client_sock, size_data):
                     break
 
                 size = int.from_bytes(size_data, byteorder='big')
 
-                # Receive frame data
-                frame_data = b''
-                while len(frame_data) < size:
-                    packet = client_sock.recv(min(8192, size - len(frame_data)))
-                    if not packet:
-                        break
-                    frame_data += packet
+                # Receive frame data straight into its own buffer
+                frame_data = bytearray(size)
+                if not recv_exact(client_sock, frame_data):
+                    break
+
+                # Decode in the pool so the next frame is read meanwhile
+                seq += 1
+                pending.append(decode_pool.submit(decode_frame, frame_data, seq))
 
-                # Decode frame
-                frame_array = np.frombuffer(frame_data, dtype=np.uint8)
-                frame = cv2.imdecode(frame_array, cv2.IMREAD_COLOR)
+                while pending and pending[0].done():
+                    pending.popleft().result()
+                while len(pending) > DECODE_WORKERS:
+                    pending.popleft().result()
 
-                if frame is not None:
-                    with frame_lock:
-                        latest_frame = frame
+            client_sock.close()
 
         except Exception as e:
             print(f"[ERROR] {e}")
             time.sleep(1)
 
+# Optional int8 OpenVINO IR of the detector (see WEB_SETUP.md)
+OPENVINO_MODEL = 'ssd_mobilenet_v2_coco_int8.xml'
+OPENVINO_WEIGHTS = 'ssd_mobilenet_v2_coco_int8.bin'
+
+def load_openvino_detector():
+    """Load the int8 IR on the OpenVINO backend, or None if unavailable"""
+    if not (os.path.exists(OPENVINO_MODEL) and os.path.exists(OPENVINO_WEIGHTS)):
+        return None
+
+    try:
+        net = cv2.dnn.readNet(OPENVINO_MODEL, OPENVINO_WEIGHTS)
+        net.setPreferableBackend(cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE)
+        net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+        # Backend errors only surface on the first forward pass
+        net.setInput(np.zeros((1, 3, 300, 300), dtype=np.float32))
+        net.forward()
+        return net
+    except Exception as e:
+        print(f"[WARNING] OpenVINO backend unavailable: {e}")
+        return None
+
 # Initialize object detector
 detector = None
+detector_is_openvino = False  # IR takes raw BGR input (see WEB_SETUP.md)
 classes = []
 try:
     print("[INFO] Loading ML models...")
-    net = cv2.dnn.readNetFromTensorflow(
-        'frozen_inference_graph.pb',
-        'ssd_mobilenet_v2_coco.pbtxt'
-    )
-    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
-    net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+    net = load_openvino_detector()
+    if net is not None:
+        detector_is_openvino = True
+        print("[INFO] Using OpenVINO int8 model")
+    else:
+        net = cv2.dnn.readNetFromTensorflow(
+            'frozen_inference_graph.pb',
+            'ssd_mobilenet_v2_coco.pbtxt'
+        )
+        net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
     detector = net
 
     with open('coco_classes.txt', 'r') as f:
@@ -333,91 +430,234 @@ except Exception as e:
     print(f"[WARNING] ML models not found: {e}")
     print("[INFO] Running without object detection")
 
+# Motion gate: detection only reruns when the mean absolute difference of a
+# MOTION_SIZE thumbnail vs. the last detected frame exceeds MOTION_THRESHOLD
+MOTION_SIZE = (32, 32)
+MOTION_THRESHOLD = 2.0
+
+# Detector input size/mean and preallocated input buffers (detection thread only)
+DETECT_SIZE = 300
+DETECT_MEAN = 127.5
+detect_resized = np.empty((DETECT_SIZE, DETECT_SIZE, 3), dtype=np.uint8)
+detect_blob = np.empty((1, 3, DETECT_SIZE, DETECT_SIZE), dtype=np.float32)
+
+# Latest detections from the detection thread: [(x1, y1, x2, y2, label)]
+latest_detections = []
+detection_lock = threading.Lock()
+
 def detect_objects(frame):
-    """Run object detection on frame"""
+    """Run object detection on frame, returns [(x1, y1, x2, y2, label)]"""
     global detected_objects_list, object_count
 
-    if not detector or not detection_enabled:
-        return frame
+    boxes = []
 
     try:
-        blob = cv2.dnn.blobFromImage(frame, 1.0, (300, 300),
-                                     [127.5, 127.5, 127.5], True, False)
-        detector.setInput(blob)
+        # Resize into buffers reused across frames
+        cv2.resize(frame, (DETECT_SIZE, DETECT_SIZE), dst=detect_resized,
+                   interpolation=cv2.INTER_LINEAR)
+        if detector_is_openvino:
+            # The IR was converted with --reverse_input_channels and keeps the
+            # model's own scaling, so it takes raw 0-255 BGR
+            np.copyto(detect_blob[0], detect_resized.transpose(2, 0, 1))  # HWC -> CHW
+        else:
+            # Same as blobFromImage(frame, 1.0, (300, 300), [127.5] * 3, True, False)
+            np.subtract(detect_resized.transpose(2, 0, 1)[::-1], DETECT_MEAN,
+                        out=detect_blob[0], dtype=np.float32)  # HWC BGR -> CHW RGB
+        detector.setInput(detect_blob)
         detections = detector.forward()
 
         height, width = frame.shape[:2]
-        detected_objects_list = []
-        object_count = 0
-
-        for i in range(detections.shape[2]):
-            confidence = detections[0, 0, i, 2]
-
-            if confidence > 0.5:
-                class_id = int(detections[0, 0, i, 1])
-                box = detections[0, 0, i, 3:7] * np.array([width, height, width, height])
-                x1, y1, x2, y2 = box.astype(int)
-
-                # Ensure box is within frame
-                x1 = max(0, min(x1, width - 1))
-                y1 = max(0, min(y1, height - 1))
-                x2 = max(0, min(x2, width - 1))
-                y2 = max(0, min(y2, height - 1))
-
-                class_name = classes[class_id] if class_id < len(classes) else f"Class{class_id}"
-                label = f"{class_name}: {confidence:.2f}"
-                detected_objects_list.append(label)
-                object_count += 1
-
-                # Draw bounding box
-                cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-
-                # Draw label
-                label_size, _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
-                cv2.rectangle(frame, (x1, y1 - label_size[1] - 10),
-                            (x1 + label_size[0], y1), (0, 255, 0), -1)
-                cv2.putText(frame, label, (x1, y1 - 5),
-                          cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 2)
+        labels = []
+
+        # Filter and scale all detections at once: rows are
+        # [image_id, class_id, confidence, x1, y1, x2, y2] (normalized box)
+        d = detections[0, 0]
+        d = d[d[:, 2] > 0.5]
+        class_ids = d[:, 1].astype(int)
+        confidences = d[:, 2]
+        coords = (d[:, 3:7] * np.array([width, height, width, height])).astype(int)
+
+        # Ensure boxes are within frame
+        np.clip(coords, 0, [width - 1, height - 1, width - 1, height - 1], out=coords)
+
+        for class_id, confidence, (x1, y1, x2, y2) in zip(class_ids.tolist(),
+                                                         confidences.tolist(),
+                                                         coords.tolist()):
+            class_name = classes[class_id] if class_id < len(classes) else f"Class{class_id}"
+            label = f"{class_name}: {confidence:.2f}"
+            labels.append(label)
+            boxes.append((x1, y1, x2, y2, label))
+
+        detected_objects_list = labels
+        object_count = len(labels)
 
     except Exception as e:
         pass
 
+    return boxes
+
+def draw_detections(frame, boxes, scale=1.0):
+    """Draw detection boxes and labels on frame, scaling box coordinates"""
+    for x1, y1, x2, y2, label in boxes:
+        x1, y1, x2, y2 = int(x1 * scale), int(y1 * scale), int(x2 * scale), int(y2 * scale)
+
+        # Draw bounding box
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+
+        # Draw label
+        label_size, _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+        cv2.rectangle(frame, (x1, y1 - label_size[1] - 10),
+                    (x1 + label_size[0], y1), (0, 255, 0), -1)
+        cv2.putText(frame, label, (x1, y1 - 5),
+                  cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 2)
+
     return frame
 
+def detection_loop():
+    """Background thread: Run object detection on the latest frame"""
+    global latest_detections
+
+    last_frame = None
+    last_small = None
+
+    while True:
+        if not detector or not detection_enabled:
+            with detection_lock:
+                latest_detections = []
+            last_small = None
+            time.sleep(0.1)
+            continue
+
+        # Frames from the receiver are never modified in place, so the
+        # detector can read the latest one without copying it
+        with frame_lock:
+            frame = latest_frame
+
+        if frame is None or frame is last_frame:
+            time.sleep(0.01)
+            continue
+        last_frame = frame
+
+        # Skip the DNN while the scene has not changed since the last
+        # detection; the previous boxes stay valid
+        small = cv2.resize(frame, MOTION_SIZE, interpolation=cv2.INTER_AREA)
+        if last_small is not None and \
+                cv2.norm(small, last_small, cv2.NORM_L1) < MOTION_THRESHOLD * small.size:
+            continue
+        last_small = small
+
+        boxes = detect_objects(frame)
+
+        with detection_lock:
+            latest_detections = boxes
+
 # Stats tracking
-frame_times = []
-bandwidth_samples = []
+frame_times = collections.deque()
+bandwidth_samples = collections.deque(maxlen=30)  # Keep last 30 frames
 
-def generate_frames():
-    """Generate MJPEG stream with detection"""
-    global latest_frame, frame_times, bandwidth_samples
+# MJPEG multipart framing around each JPEG
+MJPEG_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+MJPEG_TAIL = b'\r\n'
+
+# How often gevent clients check for a new frame (seconds)
+FRAME_POLL_INTERVAL = 0.005
+
+# Latest JPEG frame wrapped in its multipart header/tail, shared by all
+# /video_feed clients
+encoded_frame = None
+encoded_frame_id = 0
+encoded_cond = threading.Condition()
+
+def encode_jpeg(frame):
+    """Encode frame as JPEG bytes"""
+    if jpeg_encoder is not None:
+        return jpeg_encoder.encode(frame, quality=JPEG_QUALITY)
+
+    ret, buffer = cv2.imencode('.jpg', frame, JPEG_PARAMS)
+    return buffer.tobytes()
+
+def stream_loop():
+    """Background thread: Overlay detections and encode each new frame once"""
+    global encoded_frame, encoded_frame_id
+
+    last_frame = None
+
+    # Encoder-owned frame that detections are drawn into; the received frame
+    # is shared read-only with the detector and never modified
+    draw_buf = None
 
     while True:
         with frame_lock:
-            if latest_frame is None:
-                time.sleep(0.1)
-                continue
+            frame = latest_frame
 
-            frame = latest_frame.copy()
+        if frame is None or frame is last_frame:
+            time.sleep(0.005)
+            continue
+        last_frame = frame
 
-        # Run detection
-        frame = detect_objects(frame)
+        with detection_lock:
+            boxes = latest_detections
+
+        # Downscale large frames into the draw buffer
+        height, width = frame.shape[:2]
+        if height > MAX_STREAM_HEIGHT:
+            scale = STREAM_HEIGHT / height
+            size = (int(width * scale), STREAM_HEIGHT)
+            if draw_buf is None or draw_buf.shape[:2] != (size[1], size[0]):
+                draw_buf = np.empty((size[1], size[0], 3), dtype=np.uint8)
+            frame = cv2.resize(frame, size, dst=draw_buf, interpolation=cv2.INTER_AREA)
+        elif boxes:
+            # Only copy when there is something to draw
+            scale = 1.0
+            if draw_buf is None or draw_buf.shape != frame.shape:
+                draw_buf = np.empty_like(frame)
+            np.copyto(draw_buf, frame)
+            frame = draw_buf
+        else:
+            scale = 1.0
+
+        # Overlay the most recent detections
+        frame = draw_detections(frame, boxes, scale)
 
         # Track FPS
         now = time.time()
         frame_times.append(now)
-        frame_times = [t for t in frame_times if now - t < 1.0]
+        while frame_times and now - frame_times[0] >= 1.0:
+            frame_times.popleft()
 
         # Encode as JPEG
-        ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
-        frame_bytes = buffer.tobytes()
+        frame_bytes = encode_jpeg(frame)
 
         # Track bandwidth
         bandwidth_samples.append(len(frame_bytes))
-        bandwidth_samples = bandwidth_samples[-30:]  # Keep last 30 frames
 
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+        # Wrap once here so clients can send the same bytes object as-is
+        chunk = b''.join((MJPEG_HEADER, frame_bytes, MJPEG_TAIL))
+
+        # Publish to all clients
+        with encoded_cond:
+            encoded_frame = chunk
+            encoded_frame_id += 1
+            encoded_cond.notify_all()
+
+def generate_frames():
+    """Generate MJPEG stream from the shared encoded frames"""
+    last_id = 0
+
+    while True:
+        if gevent is not None:
+            # Blocking on the Condition would stall every greenlet on the hub
+            while encoded_frame_id == last_id:
+                gevent.sleep(FRAME_POLL_INTERVAL)
+
+        # Wait for a frame this client has not sent yet
+        with encoded_cond:
+            encoded_cond.wait_for(lambda: encoded_frame_id != last_id)
+            chunk = encoded_frame
+            last_id = encoded_frame_id
+
+        # One chunk (one socket write) per frame, no per-client copy
+        yield chunk
 
 @app.route('/')
 def index():
@@ -456,14 +696,27 @@ if __name__ == '__main__':
     receiver_thread = threading.Thread(target=receive_frames, daemon=True)
     receiver_thread.start()
 
+    # Start detection thread
+    detector_thread = threading.Thread(target=detection_loop, daemon=True)
+    detector_thread.start()
+
+    # Start stream encoder thread
+    stream_thread = threading.Thread(target=stream_loop, daemon=True)
+    stream_thread.start()
+
     print("\n" + "="*70)
     print("🚢 SUBMARINE VISION WEB SERVER")
     print("="*70)
     print(f"\n✓ ML Detection: {'ENABLED' if detector else 'DISABLED (models not found)'}")
+    print(f"✓ JPEG Encoder: {'libjpeg-turbo' if jpeg_encoder else 'OpenCV'}")
+    print(f"✓ HTTP Server: {'gevent' if gevent else 'Flask (development)'}")
     print(f"\n📡 Access the web interface at:")
     print(f"   → http://localhost:5000")
     print(f"   → http://<your-laptop-ip>:5000")
     print(f"\n📱 Forward port 5000 on your router for internet access!")
     print("="*70 + "\n")
 
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
+    if gevent is not None:
+        WSGIServer(('0.0.0.0', 5000), app, log=None).serve_forever()
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)